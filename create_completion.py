@@ -2,38 +2,84 @@
 import sys
 import os
 import re
+import stat
+import json
+import heapq
 import time
-import configparser
 import argparse
-import prompt_library
+import importlib.util
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from extract_paths import _PATH_RE
 
 DO_TIMESTAMPS = False
-DO_SEND_RECEIVE = False
+# Dump request/response to send.txt/response.txt, set ZSH_CODEX_DEBUG=1 to enable
+DO_SEND_RECEIVE = os.getenv("ZSH_CODEX_DEBUG") == "1"
 CODE_PATH = __file__[: __file__.rfind("/")]
 TIMESTAMP_FILE = os.path.join(CODE_PATH, "timestamps.txt")
 if DO_TIMESTAMPS and os.path.exists(TIMESTAMP_FILE):
     os.remove(TIMESTAMP_FILE)
 
-# Conditionally import OpenAI and Google Generative AI
-try:
-    from openai import OpenAI
-except ImportError:
-    OpenAI = None
-
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
-
 # Get config dir from environment or default to ~/.config
 CONFIG_DIR = os.getenv("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
 OPENAI_API_KEYS_LOCATION = os.path.join(CONFIG_DIR, "openaiapirc")
 GEMINI_API_KEYS_LOCATION = os.path.join(CONFIG_DIR, "geminiapirc")
+API_CONFIG_CACHE_LOCATION = os.path.join(CONFIG_DIR, "zsh_codex_apiconf.cache")
 
 # Allow users to pick the model they wish to run:
 OPENAI_DEFAULT_MODEL = os.getenv("OPENAI_DEFAULT_MODEL", "gpt-4o-mini")
 GEMINI_DEFAULT_MODEL = os.getenv("GEMINI_DEFAULT_MODEL", "gemini-1.5-pro-latest")
 
+# Only the tail of the zsh history is sent as context
+HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".zsh_history")
+HISTORY_TAIL_BYTES = 200_000
+HISTORY_TAIL_LINES = 1000
+HISTORY_CACHE_LOCATION = os.path.join(CONFIG_DIR, "zsh_codex_hist.cache")
+# Bump whenever the processing of the history tail changes, so stale caches
+# are rebuilt. 2: unmetafy + utf-8 instead of unicode_escape.
+HISTORY_CACHE_VERSION = 2
+
+# Cap on directory entries sent as context, most recently modified first
+LS_MAX_ENTRIES = 50
+
+# Prepended to the buffer so the model treats it as a zsh script
+ZSH_PREFIX = "#!/bin/zsh\n\n"
+
+# Static prompt messages, built once and shared by every request
+_SYS_MSG = {
+    "role": "system",
+    # "content": "You are a zsh shell expert, please help me complete the following command, you should only output the completed command, no need to include any other explanation. Do not put completed command in a code block.",
+    "content": "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block. The command should be a one-liner meant for the terminal. Shebangs like '#!/bin/bash' or '#!/bin/zsh' should NEVER be in your response. You are on MacOS. Avoid commands that are Linux exclusive, like 'apt' or 'yum'. After ",
+}
+_JSON_MSG = {
+    "role": "system",
+    "content": 'Respond with a JSON object {"cmd": <completed command>, "alt": <a different completed command>}. Both values follow the rules above.',
+}
+_CTX_HEADER = {
+    "role": "system",
+    "content": "Here is additional context to help with the command completion. You may find some of this information useful, but you are not required to use any of it unless it is relevant to the command.",
+}
+# GEMINI_PROMPT = "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block.\n\n"
+GEMINI_PROMPT = "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block. The command should be a one-liner meant for the terminal. Shebangs like '#!/bin/bash' or '#!/bin/zsh' should NEVER be in your response. You are on MacOS. Avoid reponses with potentially dangerous commands, like 'rm -rf *' or 'sudo' unless absolutely necessary. \n\n"
+
+# ini values that switch an option off
+_FALSE_VALUES = ("false", "no", "0", "off")
+
+# Start of the "cmd" value in a streamed {"cmd": ..., "alt": ...} reply
+_CMD_KEY_RE = re.compile(r'"cmd"\s*:\s*')
+
+# Only commands that look path sensitive get the ls/pwd/history context
+NEEDS_CTX = re.compile(r"(^|\s)(cd|ls|cat|rm|mv|cp|find|grep)\s|/")
+
+# Unix socket of the optional long-running zsh_codex_daemon.py. Without
+# XDG_RUNTIME_DIR it lives in a per-user directory, never directly in /tmp.
+DAEMON_SOCKET_DIR = os.getenv("XDG_RUNTIME_DIR") or os.path.join(
+    os.getenv("TMPDIR", "/tmp"), f"zsh_codex-{os.getuid()}"
+)
+DAEMON_SOCKET = os.path.join(DAEMON_SOCKET_DIR, "zsh_codex.sock")
+# Seconds to wait on the daemon before falling back to a direct request
+DAEMON_TIMEOUT = 10
+
 def timestamp(msg: str):
     """Write timestamp to TIMESTAMP_FILE with message.
 
@@ -44,7 +90,6 @@ def timestamp(msg: str):
         return
     with open(TIMESTAMP_FILE, "a") as f:
         f.write(f"[ {time.time()} ] - {msg}\n")
-        f.close()
     return
 
 
@@ -61,20 +106,11 @@ def extract_paths(text: str):
         (list[str]): List of strings of matched paths.
     """
     timestamp("begin extract_paths")
-    # regular expression patterns for unix-like and windows paths
-    unix_path_pattern = r"(\.{1,2}/\S+|/\S+|\b\S+/\S+\b)"
-    windows_path_pattern = r"[a-zA-Z]:\\(?:[^\\\s,]+\\?)*[^\\\s,]+"
-
-    # combine patterns to search for both types of paths
-    combined_pattern = f"{unix_path_pattern}|{windows_path_pattern}"
-
     # find all matches in the input string
-    matches = re.findall(combined_pattern, text)
+    matches = _PATH_RE.findall(text)
 
-    # Check that all elements of
-    if not all([[isinstance(p, str)] for p in matches]):
-        print("[ WARNING ] Failed to extract paths in zsh_codex")
-        return []
+    # Sanity check, stripped under `python -O`
+    assert all(isinstance(p, str) for p in matches)
 
     timestamp("end extract_paths")
     return matches
@@ -89,16 +125,9 @@ def extract_valid_dirs(paths: list, cwd: str):
         cwd (str): Current working directory.
 
     Returns:
-        (list): List of valid paths.
+        (list[str]): List of valid paths.
     """
-    timestamp("begin extract_valid_dirs")
-    valid_dirs = []
-    for path in paths:
-        if os.path.isdir(os.path.join(cwd, path)):
-            valid_dirs.append([path])
-
-    timestamp("end extract_valid_dirs")
-    return valid_dirs
+    return [path for path in paths if os.path.isdir(os.path.join(cwd, path))]
 
 
 def extract_valid_files(paths: list, cwd: str):
@@ -110,18 +139,128 @@ def extract_valid_files(paths: list, cwd: str):
         cwd (str): Current working directory.
 
     Returns:
-        (list): List of valid files.
+        (list[str]): List of valid files.
+    """
+    return [path for path in paths if os.path.isfile(os.path.join(cwd, path))]
+
+
+def unmetafy(data: bytes):
     """
-    timestamp("begin extract_valid_files")
-    valid_files = []
-    for path in paths:
-        if os.path.exists(os.path.join(cwd, path)) and not os.path.isdir(
-            os.path.join(cwd, path)
+    Undo zsh's history metafication: bytes that clash with zsh's internal
+    tokens are written as 0x83 followed by the byte XOR 0x20.
+
+    Args:
+        data (bytes): Raw bytes from the history file.
+
+    Returns:
+        (bytes): Plain bytes, utf-8 for a utf-8 locale.
+    """
+    if b"\x83" not in data:
+        return data
+    head, *rest = data.split(b"\x83")
+    return head + b"".join(bytes((p[0] ^ 32,)) + p[1:] for p in rest if p)
+
+
+def _read_history_tail(path: str):
+    """
+    Read the last HISTORY_TAIL_LINES commands of the zsh history.
+
+    Only the last HISTORY_TAIL_BYTES of the file are read, so the cost does
+    not grow with the size of the history.
+
+    Args:
+        path (str): Path to the zsh history file.
+
+    Returns:
+        (str): Newline separated commands with timestamps stripped.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        offset = max(0, size - HISTORY_TAIL_BYTES)
+        f.seek(offset)
+        tail = f.read()
+    if offset:
+        # Drop the partial line we seeked into
+        tail = tail[tail.find(b"\n") + 1 :]
+    lines = unmetafy(tail).decode("utf-8", errors="replace").split("\n")
+    lines = lines[-HISTORY_TAIL_LINES:]
+    # Strip the ": <epoch>:0;" extended history timestamp
+    return "\n".join([item[15:] for item in lines])
+
+
+def read_history(path: str = HISTORY_FILE):
+    """
+    Return the processed zsh history tail, reusing a cached copy when the
+    history file has not changed since it was last processed.
+
+    Args:
+        path (str): Path to the zsh history file.
+
+    Returns:
+        (str): Newline separated commands with timestamps stripped.
+    """
+    timestamp("begin read_history")
+    st = os.stat(path)
+    try:
+        with open(HISTORY_CACHE_LOCATION, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if (
+            cache.get("version") == HISTORY_CACHE_VERSION
+            and cache["path"] == path
+            and cache["mtime"] == st.st_mtime
+            and cache["size"] == st.st_size
         ):
-            valid_files.append([path])
+            timestamp("end read_history (cached)")
+            return cache["text"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    text = _read_history_tail(path)
+    cache = {
+        "version": HISTORY_CACHE_VERSION,
+        "path": path,
+        "mtime": st.st_mtime,
+        "size": st.st_size,
+        "text": text,
+    }
+    try:
+        # The cache holds shell history, keep it private to the user
+        fd = os.open(HISTORY_CACHE_LOCATION, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    timestamp("end read_history")
+    return text
+
+
+def _mtime(entry: os.DirEntry):
+    """Modification time of a directory entry, 0 if it cannot be stat'ed."""
+    try:
+        return entry.stat(follow_symlinks=False).st_mtime
+    except OSError:
+        return 0.0
+
+
+def list_dir(cwd: str):
+    """
+    List the LS_MAX_ENTRIES most recently modified entries of cwd.
 
-    timestamp("end extract_valid_files")
-    return valid_files
+    Args:
+        cwd (str): Current working directory.
+
+    Returns:
+        (list[str]): Entry names, newest first. Empty if cwd is unreadable.
+    """
+    timestamp("begin list_dir")
+    try:
+        with os.scandir(cwd) as it:
+            entries = heapq.nlargest(LS_MAX_ENTRIES, it, key=_mtime)
+    except OSError:
+        return []
+    timestamp("end list_dir")
+    return [e.name for e in entries]
 
 
 def create_template_ini_file(api_type):
@@ -149,17 +288,95 @@ def create_template_ini_file(api_type):
     timestamp("end create_template_ini_file")
 
 
+def load_api_config(api_type):
+    """
+    Read the [api_type] section of the ini file with quotes stripped.
+
+    The parsed section is cached as JSON next to the ini file, keyed on its
+    mtime and size, so configparser is only imported when the ini changed.
+
+    Args:
+        api_type (str): "openai" or "gemini".
+
+    Returns:
+        (dict): Config values of the section.
+    """
+    timestamp("begin load_api_config")
+    if api_type == "openai":
+        file_path = OPENAI_API_KEYS_LOCATION
+    else:  # gemini
+        file_path = GEMINI_API_KEYS_LOCATION
+    st = os.stat(file_path)
+    key = [file_path, st.st_mtime, st.st_size]
+
+    try:
+        with open(API_CONFIG_CACHE_LOCATION, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+    entry = cache.get(api_type)
+    if isinstance(entry, dict) and entry.get("key") == key:
+        timestamp("end load_api_config (cached)")
+        return entry["config"]
+
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read(file_path)
+    api_config = {k: v.strip("\"'") for k, v in config[api_type].items()}
+
+    cache[api_type] = {"key": key, "config": api_config}
+    try:
+        # The cache holds API keys, keep it private to the user
+        fd = os.open(
+            API_CONFIG_CACHE_LOCATION, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    timestamp("end load_api_config")
+    return api_config
+
+
+def _installed(module: str):
+    """Check whether module can be imported without importing it."""
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ModuleNotFoundError:  # parent package missing
+        return False
+
+
+def check_api_installed(api_type):
+    """
+    Exit with an install hint if the library for api_type is missing.
+    """
+    if api_type == "openai" and not _installed("openai"):
+        print(
+            "OpenAI library is not installed. Please install it using 'pip install openai'"
+        )
+        sys.exit(1)
+    elif api_type == "gemini" and not _installed("google.generativeai"):
+        print(
+            "Google Generative AI library is not installed. Please install it using 'pip install google-generativeai'"
+        )
+        sys.exit(1)
+
+
 def initialize_api(api_type):
     """
     Initialize the specified API
     """
     timestamp("begin initialize_api")
     create_template_ini_file(api_type)
-    config = configparser.ConfigParser()
+    api_config = load_api_config(api_type)
 
+    # Import only the backend in use, both are slow to import
     if api_type == "openai":
-        config.read(OPENAI_API_KEYS_LOCATION)
-        api_config = {k: v.strip("\"'") for k, v in config["openai"].items()}
+        from openai import OpenAI
+
         client = OpenAI(
             api_key=api_config["secret_key"],
             base_url=api_config.get("api_base", "https://api.openai.com/v1"),
@@ -169,84 +386,294 @@ def initialize_api(api_type):
         timestamp("end initialize_api")
         return client, api_config
     else:  # gemini
-        config.read(GEMINI_API_KEYS_LOCATION)
-        api_config = {k: v.strip("\"'") for k, v in config["gemini"].items()}
+        import google.generativeai as genai
+
         genai.configure(api_key=api_config["api_key"])
         api_config.setdefault("model", GEMINI_DEFAULT_MODEL)
         timestamp("end initialize_api")
         return genai, api_config
 
 
-def get_completion(api_type, client, config, full_command, cwd):
-    timestamp("begin get_completion")
-    home = os.environ["HOME"]
-    if api_type == "openai":
-        timestamp("1 get_completion")
-        with open(os.path.join(home, ".zsh_history"), "r", encoding="unicode_escape") as f:
-            zsh_history = f.read()
-            f.close()
-        timestamp("2 get_completion")
+def parse_json_completion(content: str):
+    """
+    Split a {"cmd": ..., "alt": ...} reply into the completion and its
+    alternative. Replies that are not such an object are used as-is.
+
+    Args:
+        content (str): Message content returned by the model.
+
+    Returns:
+        (tuple[str, str | None]): Completion and alternative completion.
+    """
+    try:
+        reply = json.loads(content)
+    except ValueError:
+        return content, None
+    if not isinstance(reply, dict) or not isinstance(reply.get("cmd"), str):
+        return content, None
+    alt = reply.get("alt")
+    return reply["cmd"], alt if isinstance(alt, str) and alt else None
+
 
-        zsh_history = zsh_history.split("\n")[-1000:]
-        timestamp("3 get_completion")
-        zsh_history = "\n".join([item[15:] for item in zsh_history])
-        timestamp("4 get_completion")
+def _rejects_json_mode(error):
+    """Whether a BadRequestError is the server refusing response_format."""
+    if getattr(error, "param", None) == "response_format":
+        return True
+    message = str(error).lower()
+    return "response_format" in message or "json_object" in message
 
+
+def read_completion_stream(stream, on_cmd=None, want_alt=True, json_reply=True):
+    """
+    Accumulate a streamed {"cmd": ..., "alt": ...} reply.
+
+    As soon as the "cmd" string is complete it is passed to on_cmd, so the
+    caller can answer before the alternative has been generated.
+
+    Args:
+        stream: Streaming chat completion response.
+        on_cmd (callable): Called with the completion once it is known.
+        want_alt (bool): If False, stop reading once "cmd" is known.
+        json_reply (bool): If False the reply is plain text, only accumulate it.
+
+    Returns:
+        (tuple[str, str | None]): Content read so far and the "cmd" value.
+    """
+    decoder = json.JSONDecoder()
+    parts = []
+    cmd = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        if cmd is not None or not json_reply:
+            continue
+        content = "".join(parts)
+        m = _CMD_KEY_RE.search(content)
+        if m is None:
+            continue
+        try:
+            value, _ = decoder.raw_decode(content, m.end())
+        except ValueError:  # string not terminated yet
+            continue
+        if not isinstance(value, str):
+            continue
+        cmd = value
+        timestamp("cmd received")
+        if on_cmd is not None:
+            on_cmd(cmd)
+        if not want_alt:
+            stream.close()
+            break
+    return "".join(parts), cmd
+
+
+def get_completion(
+    api_type,
+    client,
+    config,
+    full_command,
+    cwd,
+    with_context=True,
+    on_cmd=None,
+    want_alt=True,
+):
+    timestamp("begin get_completion")
+    if api_type == "openai":
+        json_mode = config.get("json_mode", "true").lower() not in _FALSE_VALUES
+        # Static messages are shared module-level dicts, never mutate them
         send_messages = [
-            {
-                "role": "system",
-                # "content": "You are a zsh shell expert, please help me complete the following command, you should only output the completed command, no need to include any other explanation. Do not put completed command in a code block.",
-                "content": "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block. The command should be a one-liner meant for the terminal. Shebangs like '#!/bin/bash' or '#!/bin/zsh' should NEVER be in your response. You are on MacOS. Avoid commands that are Linux exclusive, like 'apt' or 'yum'. After ",
-            },
-            {
-                "role": "user",
-                "content": full_command,
-            },
-            {
-                "role": "system",
-                "content": "Here is additional context to help with the command completion. You may find some of this information useful, but you are not required to use any of it unless it is relevant to the command.",
-            },
-            {
-                "role": "system",
-                "content": f"ls -larth: \n {os.listdir(cwd)}",
-            },
-            {
-                "role": "system",
-                "content": f"pwd: \n {cwd}",
-            },
-            {"role": "system", "content": f".zsh_history: \n {zsh_history}"},
+            _SYS_MSG,
+            _JSON_MSG,
+            {"role": "user", "content": full_command},
         ]
+        if with_context:
+            # History and directory listing are independent, fetch them together
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                fut_hist = ex.submit(read_history)
+                fut_ls = ex.submit(list_dir, cwd)
+                zsh_history = fut_hist.result()
+                ls_out = fut_ls.result()
+            send_messages += [
+                _CTX_HEADER,
+                {"role": "system", "content": f"ls -larth: \n {ls_out}"},
+                {"role": "system", "content": f"pwd: \n {cwd}"},
+                {"role": "system", "content": f".zsh_history: \n {zsh_history}"},
+            ]
         timestamp("5 get_completion")
-        response = client.chat.completions.create(
+        request = dict(
             model=config["model"],
             messages=send_messages,
             temperature=float(config.get("temperature", 1.0)),
+            stream=True,
         )
+        if json_mode:
+            from openai import BadRequestError
+
+            try:
+                # One round-trip returns both the completion and an alternative
+                stream = client.chat.completions.create(
+                    **request, response_format={"type": "json_object"}
+                )
+            except BadRequestError as e:
+                if not _rejects_json_mode(e):
+                    raise
+                # Older models and some api_base servers reject response_format.
+                # Remember it so a long-running daemon does not retry each time.
+                config["json_mode"] = "false"
+                json_mode = False
+        if not json_mode:
+            # Without JSON mode the model answers in plain text
+            send_messages = [m for m in send_messages if m is not _JSON_MSG]
+            request["messages"] = send_messages
+            stream = client.chat.completions.create(**request)
+        content, cmd = read_completion_stream(stream, on_cmd, want_alt, json_mode)
         timestamp("6 get_completion")
         if DO_SEND_RECEIVE:
-            with open(CODE_PATH + "send.txt", "w") as f:
+            with open(os.path.join(CODE_PATH, "send.txt"), "w") as f:
                 f.write(f"model = {config['model']}\n\n")
                 f.write(f"messages = {send_messages}\n\n")
-                f.close()
             timestamp("7 get_completion")
-            with open(CODE_PATH + "response.txt", "w") as f:
-                f.write(f"{response.usage.__str__()}\n\n")
-                f.write(f"{response.model.__str__()}\n\n")
-                f.write(f"{response.choices.__str__()}\n\n")
-                f.close()
+            with open(os.path.join(CODE_PATH, "response.txt"), "w") as f:
+                f.write(f"{content}\n\n")
         timestamp("end get_completion")
-        return response.choices[0].message.content
+        if not json_mode:
+            return content, None
+        if cmd is None:
+            return parse_json_completion(content)
+        # The streamed "cmd" holds even if the whole reply is not bare JSON,
+        # e.g. wrapped in a code fence
+        if not want_alt:
+            return cmd, None
+        _, alt = parse_json_completion(content)
+        return cmd, alt
     else:  # gemini
         model = client.GenerativeModel(config["model"])
         chat = model.start_chat(history=[])
-        # prompt = "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block.\n\n" + full_command
-        prompt = (
-            "You are a zsh shell expert, please help me complete the following command. Only output the completed command, no need for any other explanation. Do not put the completed command in a code block. The command should be a one-liner meant for the terminal. Shebangs like '#!/bin/bash' or '#!/bin/zsh' should NEVER be in your response. You are on MacOS. Avoid reponses with potentially dangerous commands, like 'rm -rf *' or 'sudo' unless absolutely necessary. \n\n"
-            + full_command
-        )
+        prompt = GEMINI_PROMPT + full_command
         response = chat.send_message(prompt)
         timestamp("end get_completion")
-        return response.text
+        return response.text, None
+
+
+def clean_completion(completion, buffer, cursor):
+    """
+    Strip whatever part of the buffer the model echoed back.
+
+    Args:
+        completion (str): Raw completion from the model.
+        buffer (str): Full zsh buffer.
+        cursor (int): Cursor position in the buffer.
+
+    Returns:
+        (str): Text to insert at the cursor.
+    """
+    completion = completion.removeprefix(ZSH_PREFIX)
+
+    buffer_prefix = buffer[:cursor]
+    buffer_suffix = buffer[cursor:]
+    line_prefix = buffer[buffer.rfind("\n", 0, cursor) + 1 : cursor]
+    # Handle all the different ways the command can be returned
+    for prefix in (buffer_prefix, line_prefix):
+        stripped = completion.removeprefix(prefix)
+        if len(stripped) != len(completion):
+            completion = stripped
+            break
+
+    if buffer_suffix:
+        completion = completion.removesuffix(buffer_suffix)
+
+    completion = completion.strip("\n")
+    # if line_prefix.strip().startswith("#"): # for inline #Comment replace
+    #     completion = "\n" + completion
+    return completion
+
+
+def complete(
+    api_type, client, config, buffer, cursor, cwd, on_completion=None, want_alt=True
+):
+    """
+    Complete the zsh buffer.
+
+    Args:
+        api_type (str): "openai" or "gemini".
+        client: Client returned by initialize_api.
+        config (dict): API config returned by initialize_api.
+        buffer (str): Full zsh buffer.
+        cursor (int): Cursor position in the buffer.
+        cwd (str): Current working directory.
+        on_completion (callable): Called with the cleaned completion as soon
+            as it has streamed in, before the alternative is generated.
+            Not called if the reply could not be parsed while streaming.
+        want_alt (bool): If False, no alternative is read.
+
+    Returns:
+        (tuple[str, str | None]): Text to insert at the cursor, and an
+            alternative to offer if the first one is rejected.
+    """
+    full_command = ZSH_PREFIX + buffer
+
+    # endpos limits the search to the text before the cursor without slicing
+    with_context = NEEDS_CTX.search(buffer, 0, cursor) is not None
+
+    on_cmd = None
+    if on_completion is not None:
+
+        def on_cmd(cmd):
+            on_completion(clean_completion(cmd, buffer, cursor))
+
+    completion, alt = get_completion(
+        api_type,
+        client,
+        config,
+        full_command,
+        cwd,
+        with_context,
+        on_cmd=on_cmd,
+        want_alt=want_alt,
+    )
+
+    completion = clean_completion(completion, buffer, cursor)
+    if alt is not None:
+        alt = clean_completion(alt, buffer, cursor)
+    return completion, alt
+
+
+def complete_via_daemon(api_type, buffer, cursor, cwd):
+    """
+    Ask a running zsh_codex_daemon.py for the completion.
+
+    The daemon keeps the API client, and its HTTP connection, alive across
+    completions so the TLS handshake is not paid on every keypress.
+
+    Returns:
+        (str | None): The completion, or None if no daemon could answer.
+    """
+    try:
+        st = os.stat(DAEMON_SOCKET)
+    except OSError:
+        return None
+    # Only talk to a socket of our own, the buffer may hold secrets and the
+    # reply is inserted into the command line
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+    timestamp("begin complete_via_daemon")
+    request = {"api": api_type, "buffer": buffer, "cursor": cursor, "cwd": cwd}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # A stuck daemon must not freeze the zle widget
+            sock.settimeout(DAEMON_TIMEOUT)
+            sock.connect(DAEMON_SOCKET)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                reply = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    timestamp("end complete_via_daemon")
+    return reply.get("completion")
 
 
 def main():
@@ -266,44 +693,29 @@ def main():
     parser.add_argument("--cwd", default="", help="Current working directory.")
     args = parser.parse_args()
 
-    if args.api == "openai" and OpenAI is None:
-        print(
-            "OpenAI library is not installed. Please install it using 'pip install openai'"
-        )
-        sys.exit(1)
-    elif args.api == "gemini" and genai is None:
-        print(
-            "Google Generative AI library is not installed. Please install it using 'pip install google-generativeai'"
-        )
-        sys.exit(1)
-
-    client, config = initialize_api(args.api)
-
     # Read the input prompt from stdin.
     buffer = sys.stdin.read()
-    zsh_prefix = "#!/bin/zsh\n\n"
-    buffer_prefix = buffer[: args.cursor_position]
-    buffer_suffix = buffer[args.cursor_position :]
-    full_command = zsh_prefix + buffer_prefix + buffer_suffix
-
-    completion = get_completion(args.api, client, config, full_command, args.cwd)
-
-    if completion.startswith(zsh_prefix):
-        completion = completion[len(zsh_prefix) :]
-
-    line_prefix = buffer_prefix.rsplit("\n", 1)[-1]
-    # Handle all the different ways the command can be returned
-    for prefix in [buffer_prefix, line_prefix]:
-        if completion.startswith(prefix):
-            completion = completion[len(prefix) :]
-            break
 
-    if buffer_suffix and completion.endswith(buffer_suffix):
-        completion = completion[: -len(buffer_suffix)]
+    completion = complete_via_daemon(
+        args.api, buffer, args.cursor_position, args.cwd
+    )
+    if completion is not None:
+        sys.stdout.write(completion)
+        timestamp("end main")
+        return
 
-    completion = completion.strip("\n")
-    # if line_prefix.strip().startswith("#"): # for inline #Comment replace
-    #     completion = "\n" + completion
+    check_api_installed(args.api)
+    client, config = initialize_api(args.api)
+    # The alternative is only useful to the daemon, stop once "cmd" arrives
+    completion, _ = complete(
+        args.api,
+        client,
+        config,
+        buffer,
+        args.cursor_position,
+        args.cwd,
+        want_alt=False,
+    )
 
     sys.stdout.write(completion)
     timestamp("end main")
@@ -2,25 +2,30 @@ import re
 import os
 import sys
 
+# Regular expression patterns for Unix-like and Windows paths
+# Matches Unix-like paths ("./x", "../x", "~/x", "/x", "x/y"). The lookbehind
+# only lets a match start at the beginning of a run of path characters, so each
+# token is scanned once instead of once per position. The lookahead skips the
+# "//" of "scheme://" URLs while "host:/path" and "$PATH:/usr/bin" still yield
+# the absolute path. The tail leaves out quotes and brackets and does not end
+# on sentence punctuation, except for trailing "." and ".." components.
+_UNIX = (
+    r"(?<![\w.~/-])(?!(?<=:)//)[\w.~-]*/"
+    r"""(?:(?:\.\.?/)*\.\.?(?=[\s'"()\[\]]|$)|[^\s'"()\[\]]*[^\s'"()\[\].,;])"""
+)
+# Matches Windows paths, avoiding spaces and commas. Separators are mandatory
+# between components so the nested repetition cannot backtrack ambiguously.
+_WIN = r"[a-zA-Z]:\\(?:[^\\\s,]+\\)*[^\\\s,]+"
+
+# Combine patterns to search for both types of paths, compiled once at import
+_PATH_RE = re.compile(f"{_UNIX}|{_WIN}")
 
-def extract_paths(input_string):
-    # Regular expression patterns for Unix-like and Windows paths
-    unix_path_pattern = r"(\.{1,2}/\S+|/\S+|\b\S+/\S+\b)"  # Matches Unix-like paths, preserving leading "./", "../", and more dots
-    windows_path_pattern = r"[a-zA-Z]:\\(?:[^\\\s,]+\\?)*[^\\\s,]+"  # Matches Windows paths, avoiding spaces and commas
-
-    # Combine patterns to search for both types of paths
-    combined_pattern = f"{unix_path_pattern}|{windows_path_pattern}"
 
+def extract_paths(input_string):
     # Find all matches in the input string
-    matches = re.findall(combined_pattern, input_string)
-
-    print(matches)
-
-    print([[isinstance(p, str)] for p in matches])
+    matches = _PATH_RE.findall(input_string)
 
-    if not all([[isinstance(p, str)] for p in matches]):
-        print("[ WARNING ] Failed to extract paths in zsh_codex")
-        return []
+    assert all(isinstance(p, str) for p in matches)
 
     return matches
 
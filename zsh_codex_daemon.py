@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import stat
+import fcntl
+import signal
+import threading
+import time
+import argparse
+import socketserver
+
+from create_completion import (
+    DAEMON_SOCKET,
+    check_api_installed,
+    initialize_api,
+    complete,
+    timestamp,
+)
+
+# API clients initialized so far, keyed by api type. The OpenAI client keeps
+# its HTTP connection pool open, so later requests skip the TLS handshake.
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Recent completions, keyed by (api, model, buffer, cursor, cwd), so the same
+# request repeated within CACHE_TTL seconds does not hit the API again.
+CACHE_TTL = 60
+_cache = {}
+# Handler threads share _cache; never hold the lock across an API call
+_cache_lock = threading.Lock()
+
+
+def get_client(api_type: str):
+    """
+    Return the (client, config) pair for api_type, initializing it once.
+
+    Args:
+        api_type (str): "openai" or "gemini".
+
+    Returns:
+        (tuple): Client and API config as returned by initialize_api.
+    """
+    with _clients_lock:
+        if api_type not in _clients:
+            _clients[api_type] = initialize_api(api_type)
+        return _clients[api_type]
+
+
+def cached_complete(
+    api_type: str, buffer: str, cursor: int, cwd: str, on_completion=None
+):
+    """
+    Return the completion for a request, reusing a fresh cached answer.
+
+    Repeating an identical request means the previous completion was undone,
+    so a cached alternative is served instead and the two swap places.
+    on_completion is forwarded to complete() to answer before the
+    alternative has finished streaming.
+
+    Returns:
+        (str): Text to insert at the cursor.
+    """
+    client, config = get_client(api_type)
+    key = (api_type, config.get("model"), buffer, cursor, cwd)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is not None and now - hit[0] < CACHE_TTL:
+            _, completion, alt = hit
+            if alt is None:
+                return completion
+            _cache[key] = (hit[0], alt, completion)
+            return alt
+
+    completion, alt = complete(
+        api_type, client, config, buffer, cursor, cwd, on_completion
+    )
+    with _cache_lock:
+        # Drop expired entries so the cache stays small
+        for k in [k for k, (t, _, _) in _cache.items() if now - t >= CACHE_TTL]:
+            del _cache[k]
+        _cache[key] = (now, completion, alt)
+    return completion
+
+
+class CompletionHandler(socketserver.StreamRequestHandler):
+    """
+    Answer one JSON request line of the form
+    {"api": ..., "buffer": ..., "cursor": ..., "cwd": ...}
+    with a JSON line {"completion": ...} or {"error": ...}.
+
+    The reply is sent as soon as the completion has streamed in; the
+    alternative keeps streaming into the cache after the client is gone.
+    """
+
+    def handle(self):
+        timestamp("begin daemon request")
+        self.replied = False
+        try:
+            request = json.loads(self.rfile.readline())
+            completion = cached_complete(
+                request["api"],
+                request["buffer"],
+                int(request["cursor"]),
+                request["cwd"],
+                on_completion=lambda c: self.reply({"completion": c}),
+            )
+            self.reply({"completion": completion})
+        except (Exception, SystemExit) as e:
+            self.reply({"error": str(e)})
+        timestamp("end daemon request")
+
+    def reply(self, reply: dict):
+        """Send the reply line, once. The client may already have left."""
+        if self.replied:
+            return
+        self.replied = True
+        try:
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+
+class CompletionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def prepare_socket_dir(path: str):
+    """
+    Create the socket directory if needed and make sure no other user can
+    swap the socket in it.
+
+    Args:
+        path (str): Directory that will hold the socket.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.getuid()
+        or st.st_mode & 0o022
+    ):
+        print(f"Refusing to use {path}: not a private directory owned by you")
+        sys.exit(1)
+
+
+def acquire_lock(socket_path: str):
+    """
+    Take an exclusive lock next to the socket so only one daemon serves it.
+
+    Args:
+        socket_path (str): Path of the unix socket.
+
+    Returns:
+        (int | None): Locked file descriptor, held for the daemon's lifetime,
+            or None if another daemon already holds the lock.
+    """
+    fd = os.open(socket_path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    return fd
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep an AI completion client alive for zsh_codex."
+    )
+    parser.add_argument(
+        "--api",
+        choices=["openai", "gemini"],
+        default="openai",
+        help="API to initialize at startup (default: openai)",
+    )
+    parser.add_argument(
+        "--socket", default=DAEMON_SOCKET, help="Path of the unix socket."
+    )
+    args = parser.parse_args()
+
+    prepare_socket_dir(os.path.dirname(os.path.abspath(args.socket)))
+    # Started from every new shell, so quietly leave if a daemon is running
+    lock_fd = acquire_lock(args.socket)
+    if lock_fd is None:
+        return
+
+    check_api_installed(args.api)
+    get_client(args.api)
+
+    # Holding the lock means any existing socket is stale
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    # The socket answers with shell history in the prompt, keep it private
+    old_umask = os.umask(0o077)
+    try:
+        server = CompletionServer(args.socket, CompletionHandler)
+    finally:
+        os.umask(old_umask)
+
+    # Clean up the socket on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()